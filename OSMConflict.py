@@ -1,58 +1,40 @@
 import os
 import re
-import time
-import random
 import concurrent.futures as futures
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import box
-
-import osmnx as ox
-from osmnx import geocoder as ox_geo
-from osmnx import features as ox_features
+import shapely
+from numba import njit
+
+from osm_common import (
+    COUNTRIES,
+    COUNTRY_WORKERS,
+    CONFLICT_HISTORIC_VALUES,
+    coalesce_columns,
+    collect_country,
+    lower_column,
+)
 
 OUTPUT_DIR = "europe_historic_conflict_preWW_sites_tiled"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-COUNTRIES = [
-    "Austria", "Belgium", "Bulgaria", "Czechia", "Denmark", "Finland",
-    "France", "Germany", "Greece", "Hungary", "Italy", "Luxembourg",
-    "Netherlands", "Norway", "Poland", "Portugal", "Romania", "Slovakia",
-    "Spain", "Sweden", "Switzerland", "United Kingdom"
-]
-
-CONFLICT_HISTORIC_VALUES = [
-    "battlefield", "battle_site", "battle",
-    "war_memorial", "memorial", "monument",
-    "fort", "castle", "bunker", "trench", "pillbox",
-    "tank", "aircraft", "ship", "ruins", "bomb_crater",
-]
-
-OLD_CONFLICT_PATTERN = re.compile(
-    r"(crusade|crusader|holy\s*war|templar|teutonic|hospitaller|"
+CONFLICT_PATTERN = re.compile(
+    r"(?P<modern>world\s*war|ww1|wwi|ww2|wwii|191[4-9]|1939|194[0-5]|cold\s*war|"
+    r"korean\s*war|vietnam\s*war|gulf\s*war|iraq\s*war|afghanistan\s*war|nato)"
+    r"|(?P<old>crusade|crusader|holy\s*war|templar|teutonic|hospitaller|"
     r"reconquista|reconquest|byzantine|ottoman|turkish\s+war|austro[-\s]*turkish|"
     r"habsburg[-\s]*ottoman|thirty\s*years'? war|hundred\s*years'? war|"
     r"napoleonic|napoleon|medieval|middle\s+ages|roman|frankish|carolingian|saxon\s+war)",
     re.IGNORECASE,
 )
 
-MODERN_EXCLUDE_PATTERN = re.compile(
-    r"(world\s*war|ww1|wwi|ww2|wwii|191[4-9]|1939|194[0-5]|cold\s*war|"
-    r"korean\s*war|vietnam\s*war|gulf\s*war|iraq\s*war|afghanistan\s*war|nato)",
-    re.IGNORECASE,
-)
-
-TILE_SIZE_DEG = 0.8
-MAX_WORKERS = 4
-
-ox.settings.timeout = 90
-ox.settings.use_cache = False
-ox.settings.log_console = False
-
-
-def pause(a=0.3, b=0.8):
-    time.sleep(random.uniform(a, b))
+TEXT_KEYS = [
+    "name", "name:en", "alt_name", "description", "inscription",
+    "note", "memorial", "memorial:conflict", "subject",
+    "subject:wikidata", "wikidata", "wikipedia",
+]
 
 
 def sanitize(name: str) -> str:
@@ -60,138 +42,171 @@ def sanitize(name: str) -> str:
     return re.sub(r"\s+", "_", name.strip())
 
 
-def retry(func, *args, max_tries=3, **kwargs):
-    err = None
-    for _ in range(max_tries):
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            err = e
-            pause()
-    raise err
-
-
-def make_tiles(geom, size_deg=TILE_SIZE_DEG):
-    minx, miny, maxx, maxy = geom.bounds
-    xs, x = [], minx
-    while x < maxx:
-        xs.append(x)
-        x += size_deg
-    xs.append(maxx)
-    ys, y = [], miny
-    while y < maxy:
-        ys.append(y)
-        y += size_deg
-    ys.append(maxy)
-    tiles = []
-    for i in range(len(xs) - 1):
-        for j in range(len(ys) - 1):
-            t = box(xs[i], ys[j], xs[i + 1], ys[j + 1])
-            if t.intersects(geom):
-                sub = t.intersection(geom)
-                if not sub.is_empty:
-                    tiles.append(sub)
-    return tiles
-
-
-def query_tile(tile_geom, idx, total):
-    tags = {
-        "historic": CONFLICT_HISTORIC_VALUES + ["yes", "1", "true"],
-        "military": True,
-        "landuse": "military",
-    }
-    try:
-        gdf = ox_features.features_from_polygon(tile_geom, tags)
-    except Exception:
-        return gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
-    if gdf is None or gdf.empty:
-        return gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
-    if not isinstance(gdf, gpd.GeoDataFrame):
-        gdf = gpd.GeoDataFrame(gdf, geometry="geometry")
-    if gdf.crs is None:
-        gdf.set_crs(4326, inplace=True)
-    return gdf.to_crs(4326)
-
-
-def normalize_text_fields(row, keys):
-    parts = []
-    for k in keys:
-        if k in row and pd.notna(row[k]):
-            val = row[k]
-            if isinstance(val, (list, tuple)):
-                val = " ".join(str(v) for v in val)
-            parts.append(str(val))
-    return " ".join(parts).lower()
-
-
-def classify_conflict_type(row):
-    hist = str(row.get("historic", "")).lower()
-    mil = str(row.get("military", "")).lower()
-    landuse = str(row.get("landuse", "")).lower()
-
-    text = normalize_text_fields(
-        row,
-        [
-            "name", "name:en", "alt_name", "description", "inscription",
-            "note", "memorial", "memorial:conflict", "subject",
-            "subject:wikidata", "wikidata", "wikipedia",
-        ],
-    )
-
-    if MODERN_EXCLUDE_PATTERN.search(text):
-        return None
-
-    has_old_conflict = bool(OLD_CONFLICT_PATTERN.search(text))
-
-    if hist in {"battlefield", "battle_site", "battle"}:
-        if has_old_conflict or not MODERN_EXCLUDE_PATTERN.search(hist):
-            return "pre_modern_battlefield"
+def normalize_text_fields(gdf, keys):
+    cols = [k for k in keys if k in gdf.columns]
+    if not cols:
+        return pd.Series("", index=gdf.index)
+    return gdf[cols].fillna("").astype(str).agg(" ".join, axis=1).str.lower()
 
-    if hist == "war_memorial":
-        if has_old_conflict:
-            return "pre_modern_war_memorial"
-        return None
 
-    if hist in {"memorial", "monument"}:
-        if has_old_conflict:
-            return "pre_modern_memorial_or_monument"
-        return None
+def scan_conflict_patterns(text):
+    matches = text.str.extractall(CONFLICT_PATTERN)
+    flags = matches.notna().groupby(level=0).any()
+    flags = flags.reindex(text.index, fill_value=False)
+    return flags["modern"], flags["old"]
 
-    if hist in {"fort", "castle", "bunker", "trench", "pillbox", "ruins"}:
-        if has_old_conflict or (landuse == "military" and not MODERN_EXCLUDE_PATTERN.search(text)):
-            return "pre_modern_fortification_or_military_site"
 
-    if mil:
-        if has_old_conflict and not MODERN_EXCLUDE_PATTERN.search(text):
-            return f"pre_modern_military_site:{mil}"
-        return None
+def conflict_candidates(gdf):
+    hist = lower_column(gdf, "historic")
+    mil = lower_column(gdf, "military")
+    landuse = lower_column(gdf, "landuse")
+    return (
+        hist.isin(CONFLICT_HISTORIC_VALUES + ["yes", "1", "true"])
+        | mil.ne("")
+        | landuse.eq("military")
+    )
 
-    if landuse == "military":
-        if has_old_conflict and not MODERN_EXCLUDE_PATTERN.search(text):
-            return "pre_modern_military_landuse"
-        return None
 
-    if hist in {"tank", "aircraft", "ship", "bomb_crater"}:
-        if has_old_conflict and not MODERN_EXCLUDE_PATTERN.search(text):
-            return "pre_modern_war_object"
-        return None
+# Order matters: the kernel tests the code ranges 0-2 (battle), 3
+# (war_memorial), 4-5 (memorial/monument), 6-11 (fortification), 12-15
+# (war object) and 16-18 (bare yes/1/true).
+HIST_CATEGORIES = [
+    "battlefield", "battle_site", "battle",
+    "war_memorial",
+    "memorial", "monument",
+    "fort", "castle", "bunker", "trench", "pillbox", "ruins",
+    "tank", "aircraft", "ship", "bomb_crater",
+    "yes", "1", "true",
+]
 
-    if hist in {"yes", "1", "true"} and has_old_conflict:
-        return "pre_modern_historic_conflict_feature"
+CONFLICT_LABELS = np.array([
+    "pre_modern_battlefield",
+    "pre_modern_war_memorial",
+    "pre_modern_memorial_or_monument",
+    "pre_modern_fortification_or_military_site",
+    "pre_modern_military_site",
+    "pre_modern_military_landuse",
+    "pre_modern_war_object",
+    "pre_modern_historic_conflict_feature",
+], dtype=object)
+
+
+@njit(cache=True)
+def _classify_kernel(hist_code, has_military, military_landuse,
+                     has_old, is_modern, hist_modern):
+    n = hist_code.shape[0]
+    out = np.full(n, -1, np.int8)
+    for i in range(n):
+        if is_modern[i]:
+            continue
+        h = hist_code[i]
+        if 0 <= h <= 2:
+            if has_old[i] or not hist_modern[i]:
+                out[i] = 0
+                continue
+        if h == 3:
+            if has_old[i]:
+                out[i] = 1
+            continue
+        if h == 4 or h == 5:
+            if has_old[i]:
+                out[i] = 2
+            continue
+        if 6 <= h <= 11:
+            if has_old[i] or military_landuse[i]:
+                out[i] = 3
+                continue
+        if has_military[i]:
+            if has_old[i]:
+                out[i] = 4
+            continue
+        if military_landuse[i]:
+            if has_old[i]:
+                out[i] = 5
+            continue
+        if 12 <= h <= 15:
+            if has_old[i]:
+                out[i] = 6
+            continue
+        if h >= 16 and has_old[i]:
+            out[i] = 7
+    return out
+
+
+def classify_conflict_types(hist, mil, landuse, text):
+    is_modern, has_old = scan_conflict_patterns(text)
+    hist_modern, _ = scan_conflict_patterns(hist)
+
+    hist_code = pd.Categorical(hist, categories=HIST_CATEGORIES).codes.astype(np.int8)
+    cls = _classify_kernel(
+        hist_code,
+        mil.ne("").to_numpy(dtype=bool),
+        landuse.eq("military").to_numpy(dtype=bool),
+        has_old.to_numpy(),
+        is_modern.to_numpy(),
+        hist_modern.to_numpy(),
+    )
 
-    return None
+    out = pd.Series(None, index=hist.index, dtype="object")
+    matched = cls >= 0
+    out[matched] = CONFLICT_LABELS[cls[matched]]
+    mil_site = cls == 4
+    if mil_site.any():
+        out[mil_site] = "pre_modern_military_site:" + mil[mil_site]
+    return out
 
 
 def tidy_conflict_sites(gdf: gpd.GeoDataFrame) -> pd.DataFrame:
+    out_cols = ["name", "conflict_type", "lat", "lon", "osm_id", "wikidata", "wikipedia"]
     if gdf.empty:
-        return pd.DataFrame(columns=[
-            "name", "conflict_type", "lat", "lon", "osm_id", "wikidata", "wikipedia"
-        ])
+        return pd.DataFrame(columns=out_cols)
+
+    hist_l = lower_column(gdf, "historic")
+    mil_l = lower_column(gdf, "military")
+    landuse_l = lower_column(gdf, "landuse")
+
+    # Rows whose coarse tags cannot classify never need the text regexes.
+    cand = (
+        hist_l.isin(CONFLICT_HISTORIC_VALUES + ["yes", "1", "true"])
+        | mil_l.ne("")
+        | landuse_l.eq("military")
+    ).to_numpy(dtype=bool)
+
+    conflict_type = pd.Series(None, index=gdf.index, dtype="object")
+    ci = np.flatnonzero(cand)
+    if ci.size:
+        rng = pd.RangeIndex(ci.size)
+        hist_c = hist_l.take(ci).set_axis(rng)
+        mil_c = mil_l.take(ci).set_axis(rng)
+        landuse_c = landuse_l.take(ci).set_axis(rng)
+        text_sub = pd.DataFrame(
+            {c: gdf[c].to_numpy()[ci] for c in TEXT_KEYS if c in gdf.columns},
+            index=rng,
+        )
+        text_c = normalize_text_fields(text_sub, TEXT_KEYS)
+        sub_type = classify_conflict_types(hist_c, mil_c, landuse_c, text_c)
+        conflict_type.iloc[ci] = sub_type.to_numpy()
+
+    idx = np.flatnonzero(conflict_type.notna().to_numpy())
+    if idx.size == 0:
+        return pd.DataFrame(columns=out_cols)
+
+    if "osmid" in gdf.columns:
+        osmid = gdf["osmid"].to_numpy()[idx]
+        if "element_type" in gdf.columns:
+            etype = gdf["element_type"].to_numpy()[idx]
+            dup = pd.DataFrame({"element_type": etype, "osmid": osmid}).duplicated()
+        else:
+            dup = pd.Series(osmid).duplicated()
+        keep = ~dup.to_numpy()
+        idx = idx[keep]
+        osm_id = pd.Series(osmid[keep]).astype(str).to_numpy()
+    else:
+        osm_id = gdf.index[idx].astype(str)
 
-    geom = gdf.geometry
-    cent = geom.where(geom.geom_type == "Point", geom.centroid)
-    gdf["lon"] = cent.x
-    gdf["lat"] = cent.y
+    geoms = np.asarray(gdf.geometry.values)[idx]
+    is_point = shapely.get_type_id(geoms) == 0
+    cent = np.where(is_point, geoms, shapely.centroid(geoms))
 
     name_cols = [
         c for c in ("name", "name:en", "alt_name", "old_name",
@@ -199,34 +214,22 @@ def tidy_conflict_sites(gdf: gpd.GeoDataFrame) -> pd.DataFrame:
         if c in gdf.columns
     ]
     if name_cols:
-        gdf["name"] = gdf[name_cols].bfill(axis=1).iloc[:, 0]
+        sub = pd.DataFrame({c: gdf[c].to_numpy()[idx] for c in name_cols})
+        name = coalesce_columns(sub, name_cols).to_numpy()
     else:
-        gdf["name"] = None
-
-    conflict_type = gdf.apply(classify_conflict_type, axis=1)
-    mask = conflict_type.notna()
-    if not mask.any():
-        return pd.DataFrame(columns=[
-            "name", "conflict_type", "lat", "lon", "osm_id", "wikidata", "wikipedia"
-        ])
+        name = None
 
-    gdf = gdf[mask].copy()
-    gdf["conflict_type"] = conflict_type[mask]
-
-    if "osmid" in gdf.columns:
-        gdf = gdf.drop_duplicates(subset=["osmid"])
-        osm_id = gdf["osmid"].astype(str)
-    else:
-        osm_id = gdf.index.astype(str)
+    def sliced(col):
+        return gdf[col].to_numpy()[idx] if col in gdf.columns else None
 
     out = pd.DataFrame({
-        "name": gdf["name"],
-        "conflict_type": gdf["conflict_type"],
-        "lat": gdf["lat"],
-        "lon": gdf["lon"],
+        "name": name,
+        "conflict_type": conflict_type.to_numpy()[idx],
+        "lat": shapely.get_y(cent),
+        "lon": shapely.get_x(cent),
         "osm_id": osm_id,
-        "wikidata": gdf.get("wikidata", pd.Series(index=gdf.index, dtype="object")),
-        "wikipedia": gdf.get("wikipedia", pd.Series(index=gdf.index, dtype="object")),
+        "wikidata": sliced("wikidata"),
+        "wikipedia": sliced("wikipedia"),
     })
 
     out["__has_name"] = out["name"].notna() & (out["name"].astype(str) != "")
@@ -239,44 +242,20 @@ def tidy_conflict_sites(gdf: gpd.GeoDataFrame) -> pd.DataFrame:
 
 
 def run_country(country: str):
-    try:
-        country_gdf = retry(ox_geo.geocode_to_gdf, country)
-    except Exception:
-        return
-    geom = country_gdf.geometry.iloc[0]
-    tiles = make_tiles(geom)
-    if not tiles:
+    all_gdf = collect_country(country)
+    if all_gdf is None or all_gdf.empty:
         return
-    frames = []
-    with futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
-        tasks = (
-            ex.submit(query_tile, tile_geom, idx, len(tiles))
-            for idx, tile_geom in enumerate(tiles)
-        )
-        for fut in futures.as_completed(tasks):
-            g = fut.result()
-            if g is not None and not g.empty:
-                frames.append(g)
-    if not frames:
-        return
-    all_gdf = gpd.GeoDataFrame(
-        pd.concat(frames, ignore_index=True),
-        geometry="geometry",
-        crs="EPSG:4326"
-    )
+    all_gdf = all_gdf[conflict_candidates(all_gdf)].copy()
     df = tidy_conflict_sites(all_gdf)
-    fname = f"{sanitize(country)}_historic_conflict_preWW_sites_tiled.xlsx"
+    fname = f"{sanitize(country)}_historic_conflict_preWW_sites_tiled.parquet"
     path = os.path.join(OUTPUT_DIR, fname)
-    df.to_excel(path, index=False)
+    df.to_parquet(path, engine="pyarrow", compression="zstd", index=False)
 
 
 def main():
-    for c in COUNTRIES:
-        run_country(c)
-
-
-if __name__ == "__main__":
-    main()
+    workers = min(len(COUNTRIES), COUNTRY_WORKERS, os.cpu_count() or 1)
+    with futures.ProcessPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(run_country, COUNTRIES))
 
 
 if __name__ == "__main__":
@@ -1,38 +1,25 @@
 import os
 import re
-import time
-import random
 import concurrent.futures as futures
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import box
-
-import osmnx as ox
-from osmnx import geocoder as ox_geo
-from osmnx import features as ox_features
+import shapely
+
+from osm_common import (
+    COUNTRIES,
+    COUNTRY_WORKERS,
+    RELIGIOUS_BUILDINGS,
+    RELIGIOUS_HISTORIC,
+    coalesce_columns,
+    collect_country,
+    lower_column,
+)
 
 OUTPUT_DIR = "europe_religious_historic_sites_tiled"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-COUNTRIES = [
-    "Austria", "Belgium", "Bulgaria", "Czechia", "Denmark", "Finland",
-    "France", "Germany", "Greece", "Hungary", "Italy", "Luxembourg",
-    "Netherlands", "Norway", "Poland", "Portugal", "Romania", "Slovakia",
-    "Spain", "Sweden", "Switzerland", "United Kingdom"
-]
-
-RELIGIOUS_BUILDINGS = [
-    "church", "chapel", "cathedral", "monastery", "abbey",
-    "basilica", "mosque", "synagogue", "temple", "shrine"
-]
-
-RELIGIOUS_HISTORIC = [
-    "church", "chapel", "cathedral", "monastery", "abbey",
-    "basilica", "mosque", "synagogue", "temple",
-    "wayside_shrine", "wayside_cross", "religious"
-]
-
 CIV_KEYS = [
     "historic:civilization",
     "civilization",
@@ -40,113 +27,45 @@ CIV_KEYS = [
     "culture",
 ]
 
-TILE_SIZE_DEG = 0.8
-MAX_WORKERS = 4
-
-ox.settings.timeout = 90
-ox.settings.use_cache = False
-ox.settings.log_console = False
-
-
-def pause(a=0.3, b=0.8):
-    time.sleep(random.uniform(a, b))
-
 
 def sanitize(name: str) -> str:
     name = re.sub(r'[\\/:*?"<>|]', "_", name)
     return re.sub(r"\s+", "_", name.strip())
 
 
-def retry(func, *args, max_tries=3, **kwargs):
-    err = None
-    for _ in range(max_tries):
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            err = e
-            pause()
-    raise err
-
-
-def make_tiles(geom, size_deg=TILE_SIZE_DEG):
-    minx, miny, maxx, maxy = geom.bounds
-    xs, x = [], minx
-    while x < maxx:
-        xs.append(x)
-        x += size_deg
-    xs.append(maxx)
-    ys, y = [], miny
-    while y < maxy:
-        ys.append(y)
-        y += size_deg
-    ys.append(maxy)
-    tiles = []
-    for i in range(len(xs) - 1):
-        for j in range(len(ys) - 1):
-            t = box(xs[i], ys[j], xs[i + 1], ys[j + 1])
-            if t.intersects(geom):
-                sub = t.intersection(geom)
-                if not sub.is_empty:
-                    tiles.append(sub)
-    return tiles
-
-
-def query_tile(tile_geom, idx, total):
-    tags = {
-        "historic": RELIGIOUS_HISTORIC + ["yes", "1", "true"],
-        "amenity": "place_of_worship",
-        "building": RELIGIOUS_BUILDINGS,
-    }
-    try:
-        gdf = ox_features.features_from_polygon(tile_geom, tags)
-    except Exception:
-        return gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
-    if gdf is None or gdf.empty:
-        return gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
-    if not isinstance(gdf, gpd.GeoDataFrame):
-        gdf = gpd.GeoDataFrame(gdf, geometry="geometry")
-    if gdf.crs is None:
-        gdf.set_crs(4326, inplace=True)
-    return gdf.to_crs(4326)
-
-
-def extract_civilization_from_row(row):
-    for key in CIV_KEYS:
-        if key in row and pd.notna(row[key]):
-            val = row[key]
-            if isinstance(val, (list, tuple)) and val:
-                val = val[0]
-            val = str(val).strip()
-            if val:
-                return val
-    return None
+def religious_candidates(gdf):
+    hist = lower_column(gdf, "historic")
+    bldg = lower_column(gdf, "building")
+    amen = lower_column(gdf, "amenity")
+    return (
+        hist.isin(RELIGIOUS_HISTORIC + ["yes", "1", "true"])
+        | bldg.isin(RELIGIOUS_BUILDINGS)
+        | amen.eq("place_of_worship")
+    )
 
 
-def tidy_religious_historic(gdf: gpd.GeoDataFrame) -> pd.DataFrame:
-    if gdf.empty:
-        return pd.DataFrame(columns=[
-            "name", "site_type", "civilization",
-            "lat", "lon", "osm_id", "wikidata", "wikipedia"
-        ])
+def extract_civilizations(gdf):
+    civ = pd.Series(None, index=gdf.index, dtype="object")
+    for key in CIV_KEYS:
+        if key not in gdf.columns:
+            continue
+        s = gdf[key].map(lambda v: v[0] if isinstance(v, (list, tuple)) and v else v)
+        s = s.where(s.notna(), "").astype(str).str.strip()
+        civ = civ.where(civ.notna(), s.where(s.ne(""), None))
+    return civ
 
-    geom = gdf.geometry
-    cent = geom.where(geom.geom_type == "Point", geom.centroid)
-    gdf["lon"] = cent.x
-    gdf["lat"] = cent.y
 
-    name_cols = [
-        c for c in ("name", "name:en", "alt_name", "old_name",
-                    "loc_name", "official_name")
-        if c in gdf.columns
+def tidy_religious_historic(gdf: gpd.GeoDataFrame) -> pd.DataFrame:
+    out_cols = [
+        "name", "site_type", "civilization",
+        "lat", "lon", "osm_id", "wikidata", "wikipedia"
     ]
-    if name_cols:
-        gdf["name"] = gdf[name_cols].bfill(axis=1).iloc[:, 0]
-    else:
-        gdf["name"] = None
+    if gdf.empty:
+        return pd.DataFrame(columns=out_cols)
 
-    hist = gdf.get("historic", "").astype(str).str.lower()
-    bldg = gdf.get("building", "").astype(str).str.lower()
-    amen = gdf.get("amenity", "").astype(str).str.lower()
+    hist = lower_column(gdf, "historic")
+    bldg = lower_column(gdf, "building")
+    amen = lower_column(gdf, "amenity")
 
     hist_yes = hist.isin(["yes", "1", "true"])
     hist_rel = hist.isin(RELIGIOUS_HISTORIC)
@@ -158,32 +77,56 @@ def tidy_religious_historic(gdf: gpd.GeoDataFrame) -> pd.DataFrame:
     site_type[amen_pow & hist_yes] = "historic:place_of_worship"
     site_type[bldg_rel & hist_yes] = "historic_building:" + bldg[bldg_rel & hist_yes]
 
-    mask = site_type.notna()
-    if not mask.any():
-        return pd.DataFrame(columns=[
-            "name", "site_type", "civilization",
-            "lat", "lon", "osm_id", "wikidata", "wikipedia"
-        ])
-
-    gdf = gdf[mask].copy()
-    gdf["site_type"] = site_type[mask]
-    gdf["civilization"] = gdf.apply(extract_civilization_from_row, axis=1)
+    idx = np.flatnonzero(site_type.notna().to_numpy())
+    if idx.size == 0:
+        return pd.DataFrame(columns=out_cols)
 
     if "osmid" in gdf.columns:
-        gdf = gdf.drop_duplicates(subset=["osmid"])
-        osm_id = gdf["osmid"].astype(str)
+        osmid = gdf["osmid"].to_numpy()[idx]
+        if "element_type" in gdf.columns:
+            etype = gdf["element_type"].to_numpy()[idx]
+            dup = pd.DataFrame({"element_type": etype, "osmid": osmid}).duplicated()
+        else:
+            dup = pd.Series(osmid).duplicated()
+        keep = ~dup.to_numpy()
+        idx = idx[keep]
+        osm_id = pd.Series(osmid[keep]).astype(str).to_numpy()
+    else:
+        osm_id = gdf.index[idx].astype(str)
+
+    geoms = np.asarray(gdf.geometry.values)[idx]
+    is_point = shapely.get_type_id(geoms) == 0
+    cent = np.where(is_point, geoms, shapely.centroid(geoms))
+
+    name_cols = [
+        c for c in ("name", "name:en", "alt_name", "old_name",
+                    "loc_name", "official_name")
+        if c in gdf.columns
+    ]
+    if name_cols:
+        sub = pd.DataFrame({c: gdf[c].to_numpy()[idx] for c in name_cols})
+        name = coalesce_columns(sub, name_cols).to_numpy()
     else:
-        osm_id = gdf.index.astype(str)
+        name = None
+
+    civ_cols = [c for c in CIV_KEYS if c in gdf.columns]
+    civ_sub = pd.DataFrame(
+        {c: gdf[c].to_numpy()[idx] for c in civ_cols},
+        index=pd.RangeIndex(idx.size),
+    )
+
+    def sliced(col):
+        return gdf[col].to_numpy()[idx] if col in gdf.columns else None
 
     out = pd.DataFrame({
-        "name": gdf["name"],
-        "site_type": gdf["site_type"],
-        "civilization": gdf["civilization"],
-        "lat": gdf["lat"],
-        "lon": gdf["lon"],
+        "name": name,
+        "site_type": site_type.to_numpy()[idx],
+        "civilization": extract_civilizations(civ_sub).to_numpy(),
+        "lat": shapely.get_y(cent),
+        "lon": shapely.get_x(cent),
         "osm_id": osm_id,
-        "wikidata": gdf.get("wikidata", pd.Series(index=gdf.index, dtype="object")),
-        "wikipedia": gdf.get("wikipedia", pd.Series(index=gdf.index, dtype="object")),
+        "wikidata": sliced("wikidata"),
+        "wikipedia": sliced("wikipedia"),
     })
 
     out["__has_name"] = out["name"].notna() & (out["name"].astype(str) != "")
@@ -196,41 +139,20 @@ def tidy_religious_historic(gdf: gpd.GeoDataFrame) -> pd.DataFrame:
 
 
 def run_country(country: str):
-    qname = ALIAS.get(country, country)
-    try:
-        country_gdf = retry(ox_geo.geocode_to_gdf, qname)
-    except Exception:
-        return
-    geom = country_gdf.geometry.iloc[0]
-    tiles = make_tiles(geom)
-    if not tiles:
+    all_gdf = collect_country(country)
+    if all_gdf is None or all_gdf.empty:
         return
-    frames = []
-    with futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
-        tasks = (
-            ex.submit(query_tile, tile_geom, idx, len(tiles))
-            for idx, tile_geom in enumerate(tiles)
-        )
-        for fut in futures.as_completed(tasks):
-            g = fut.result()
-            if g is not None and not g.empty:
-                frames.append(g)
-    if not frames:
-        return
-    all_gdf = gpd.GeoDataFrame(
-        pd.concat(frames, ignore_index=True),
-        geometry="geometry",
-        crs="EPSG:4326"
-    )
+    all_gdf = all_gdf[religious_candidates(all_gdf)].copy()
     df = tidy_religious_historic(all_gdf)
-    fname = f"{sanitize(country)}_religious_historic_sites_tiled.xlsx"
+    fname = f"{sanitize(country)}_religious_historic_sites_tiled.parquet"
     path = os.path.join(OUTPUT_DIR, fname)
-    df.to_excel(path, index=False)
+    df.to_parquet(path, engine="pyarrow", compression="zstd", index=False)
 
 
 def main():
-    for c in COUNTRIES:
-        run_country(c)
+    workers = min(len(COUNTRIES), COUNTRY_WORKERS, os.cpu_count() or 1)
+    with futures.ProcessPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(run_country, COUNTRIES))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,337 @@
+import os
+import asyncio
+import hashlib
+import functools
+import socket
+import time
+import random
+
+import aiohttp
+import requests
+import numpy as np
+import pyarrow as pa
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+import osmnx as ox
+from osmnx import geocoder as ox_geo
+
+COUNTRIES = [
+    "Austria", "Belgium", "Bulgaria", "Czechia", "Denmark", "Finland",
+    "France", "Germany", "Greece", "Hungary", "Italy", "Luxembourg",
+    "Netherlands", "Norway", "Poland", "Portugal", "Romania", "Slovakia",
+    "Spain", "Sweden", "Switzerland", "United Kingdom"
+]
+
+ALIAS = {}
+
+CONFLICT_HISTORIC_VALUES = [
+    "battlefield", "battle_site", "battle",
+    "war_memorial", "memorial", "monument",
+    "fort", "castle", "bunker", "trench", "pillbox",
+    "tank", "aircraft", "ship", "ruins", "bomb_crater",
+]
+
+RELIGIOUS_BUILDINGS = [
+    "church", "chapel", "cathedral", "monastery", "abbey",
+    "basilica", "mosque", "synagogue", "temple", "shrine"
+]
+
+RELIGIOUS_HISTORIC = [
+    "church", "chapel", "cathedral", "monastery", "abbey",
+    "basilica", "mosque", "synagogue", "temple",
+    "wayside_shrine", "wayside_cross", "religious"
+]
+
+# Union of the tag filters the three scripts used to request separately;
+# one Overpass query per tile serves all of them.
+UNION_TAGS = {
+    "historic": sorted(set(
+        CONFLICT_HISTORIC_VALUES + RELIGIOUS_HISTORIC + ["yes", "1", "true"]
+    )),
+    "military": True,
+    "landuse": "military",
+    "amenity": "place_of_worship",
+    "building": RELIGIOUS_BUILDINGS,
+}
+
+# Seed tiles start coarse; query_tile quarters any tile that times out
+# or comes back with too many features, down to MAX_SPLIT_DEPTH levels.
+SEED_TILE_SIZE_DEG = 3.2
+MAX_TILE_FEATURES = 25000
+MAX_SPLIT_DEPTH = 3
+
+# Aggregate politeness budget against the shared Overpass endpoint:
+# COUNTRY_WORKERS processes each hold a MAX_WORKERS semaphore, so their
+# product is the global in-flight request cap (same as the original
+# 4-thread pool).
+OVERPASS_BUDGET = 4
+COUNTRY_WORKERS = 4
+MAX_WORKERS = max(1, OVERPASS_BUDGET // COUNTRY_WORKERS)
+
+TILE_CACHE_DIR = os.path.join(".tile_cache", "union")
+os.makedirs(TILE_CACHE_DIR, exist_ok=True)
+
+OVERPASS_URL = "https://overpass-api.de/api/interpreter"
+
+ox.settings.timeout = 90
+ox.settings.use_cache = True
+ox.settings.cache_folder = ".osm_cache"
+ox.settings.log_console = False
+
+
+TRANSIENT_STATUS = {429, 500, 502, 503, 504}
+
+
+def is_transient(exc):
+    status = getattr(exc, "status", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    if status is not None:
+        return status in TRANSIENT_STATUS
+    return isinstance(exc, (
+        asyncio.TimeoutError,
+        socket.timeout,
+        aiohttp.ClientConnectionError,
+        requests.Timeout,
+        requests.ConnectionError,
+    ))
+
+
+def backoff(attempt):
+    return min(60, 2 ** attempt + random.uniform(0, 1))
+
+
+def retry(func, *args, max_tries=3, **kwargs):
+    for attempt in range(max_tries):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if not is_transient(e) or attempt == max_tries - 1:
+                raise
+            time.sleep(backoff(attempt))
+
+
+def make_tiles(geom, size_deg=SEED_TILE_SIZE_DEG):
+    minx, miny, maxx, maxy = geom.bounds
+    xs = np.append(np.arange(minx, maxx, size_deg), maxx)
+    ys = np.append(np.arange(miny, maxy, size_deg), maxy)
+    x0, y0 = np.meshgrid(xs[:-1], ys[:-1])
+    x1, y1 = np.meshgrid(xs[1:], ys[1:])
+    tiles = shapely.box(x0.ravel(), y0.ravel(), x1.ravel(), y1.ravel())
+    shapely.prepare(geom)
+    tiles = tiles[shapely.intersects(tiles, geom)]
+    covered = shapely.covers(geom, tiles)
+    subs = shapely.intersection(tiles[~covered], geom)
+    subs = subs[~shapely.is_empty(subs)]
+    return list(tiles[covered]) + list(subs)
+
+
+def ensure_wgs84(gdf):
+    if gdf.crs is None:
+        return gdf.set_crs(4326)
+    if gdf.crs.to_epsg() != 4326:
+        return gdf.to_crs(4326)
+    return gdf
+
+
+def tile_cached(func):
+    @functools.wraps(func)
+    async def wrapper(session, sem, tile_geom, *args, **kwargs):
+        key = hashlib.sha1(tile_geom.wkb).hexdigest()
+        path = os.path.join(TILE_CACHE_DIR, f"{key}.parquet")
+        if os.path.exists(path):
+            try:
+                return ensure_wgs84(gpd.read_parquet(path))
+            except Exception:
+                pass
+        gdf = await func(session, sem, tile_geom, *args, **kwargs)
+        # None signals a failed fetch; cache only real responses so the
+        # tile is retried on the next run instead of pinned empty.
+        if gdf is not None:
+            try:
+                gdf.to_parquet(path)
+            except Exception:
+                pass
+        return gdf
+    return wrapper
+
+
+def overpass_query(tile_geom, tags):
+    filters = []
+    polys = [p for p in getattr(tile_geom, "geoms", [tile_geom])
+             if p.geom_type == "Polygon"]
+    for key, val in tags.items():
+        if val is True:
+            selector = f'["{key}"]'
+        elif isinstance(val, str):
+            selector = f'["{key}"="{val}"]'
+        else:
+            selector = f'["{key}"~"^({"|".join(val)})$"]'
+        for poly in polys:
+            coords = " ".join(f"{y:.6f} {x:.6f}" for x, y in poly.exterior.coords)
+            filters.append(f'nwr{selector}(poly:"{coords}");')
+    return f"[out:json][timeout:{ox.settings.timeout}];({''.join(filters)});out tags center;"
+
+
+def elements_to_gdf(elements):
+    records, geoms = [], []
+    for el in elements:
+        tags = el.get("tags")
+        if not tags:
+            continue
+        coords = el if el.get("type") == "node" else el.get("center")
+        if not coords or "lat" not in coords:
+            continue
+        rec = dict(tags)
+        rec["element_type"] = el["type"]
+        rec["osmid"] = el["id"]
+        records.append(rec)
+        geoms.append(shapely.Point(coords["lon"], coords["lat"]))
+    if not records:
+        return gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
+    return gpd.GeoDataFrame(records, geometry=geoms, crs="EPSG:4326")
+
+
+def split_tile(tile_geom):
+    minx, miny, maxx, maxy = tile_geom.bounds
+    midx = (minx + maxx) / 2
+    midy = (miny + maxy) / 2
+    quads = shapely.box(
+        np.array([minx, midx, minx, midx]),
+        np.array([miny, miny, midy, midy]),
+        np.array([midx, maxx, midx, maxx]),
+        np.array([midy, midy, maxy, maxy]),
+    )
+    shapely.prepare(tile_geom)
+    covered = shapely.covers(tile_geom, quads)
+    subs = shapely.intersection(quads[~covered], tile_geom)
+    subs = subs[~shapely.is_empty(subs)]
+    return list(quads[covered]) + list(subs)
+
+
+@tile_cached
+async def query_tile(session, sem, tile_geom, depth=0):
+    query = overpass_query(tile_geom, UNION_TAGS)
+    gdf = None
+    timed_out = False
+    for attempt in range(3):
+        try:
+            async with sem:
+                async with session.post(OVERPASS_URL, data={"data": query}) as resp:
+                    resp.raise_for_status()
+                    payload = await resp.json()
+            gdf = elements_to_gdf(payload.get("elements", []))
+            break
+        except Exception as e:
+            if not is_transient(e):
+                break
+            timed_out = True
+            if attempt < 2:
+                await asyncio.sleep(backoff(attempt))
+    overflow = gdf is not None and len(gdf) >= MAX_TILE_FEATURES
+    if ((gdf is None and timed_out) or overflow) and depth < MAX_SPLIT_DEPTH:
+        children = split_tile(tile_geom)
+        if children:
+            parts = await asyncio.gather(
+                *(query_tile(session, sem, c, depth + 1) for c in children)
+            )
+            # A failed quarter poisons the parent: a partial concat must
+            # not be cached under the parent's key as if complete.
+            if any(p is None for p in parts):
+                return None
+            parts = [p for p in parts if not p.empty]
+            if parts:
+                return concat_frames(parts)
+            return gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
+    return gdf
+
+
+async def fetch_tiles(tiles):
+    sem = asyncio.Semaphore(MAX_WORKERS)
+    timeout = aiohttp.ClientTimeout(total=ox.settings.timeout + 30)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        return await asyncio.gather(*(query_tile(session, sem, t) for t in tiles))
+
+
+def collect_country(country):
+    qname = ALIAS.get(country, country)
+    try:
+        country_gdf = retry(ox_geo.geocode_to_gdf, qname)
+    except Exception:
+        return None
+    geom = country_gdf.geometry.iloc[0]
+    tiles = make_tiles(geom)
+    if not tiles:
+        return None
+    results = asyncio.run(fetch_tiles(tiles))
+    seen = set()
+    frames = []
+    for g in results:
+        if g is None or g.empty:
+            continue
+        if "osmid" in g.columns and "element_type" in g.columns:
+            # Node/way/relation ids live in separate OSM id spaces, so
+            # the dedup key must include the element type.
+            ids = pd.Series(
+                list(zip(g["element_type"], g["osmid"])), index=g.index
+            )
+            mask = ~ids.isin(seen)
+            if not mask.all():
+                g = g[mask]
+                if g.empty:
+                    continue
+            seen.update(ids[mask])
+        frames.append(g)
+    if not frames:
+        return None
+    return arrow_strings(concat_frames(frames))
+
+
+def concat_frames(frames):
+    tables = [
+        pa.Table.from_pandas(
+            pd.DataFrame(g.drop(columns="geometry")), preserve_index=False
+        )
+        for g in frames
+    ]
+    attrs = pa.concat_tables(tables, promote_options="permissive")
+    geoms = np.concatenate([np.asarray(g.geometry.values) for g in frames])
+    return gpd.GeoDataFrame(
+        attrs.to_pandas(types_mapper=pd.ArrowDtype),
+        geometry=gpd.GeoSeries(geoms, crs="EPSG:4326"),
+    )
+
+
+# Tag columns consulted repeatedly via .str ops downstream; kept as
+# Arrow-backed strings so those ops hit the Arrow compute kernels.
+STRING_TAG_COLS = [
+    "historic", "military", "landuse", "amenity", "building",
+    "name", "name:en", "alt_name", "old_name", "loc_name", "official_name",
+    "denomination", "religion:denomination", "religion",
+    "wikidata", "wikipedia",
+]
+
+
+def arrow_strings(gdf, cols=STRING_TAG_COLS):
+    for col in cols:
+        if col in gdf.columns:
+            gdf[col] = gdf[col].astype("string[pyarrow]")
+    return gdf
+
+
+def lower_column(gdf, col):
+    if col not in gdf.columns:
+        return pd.Series("", index=gdf.index, dtype="string[pyarrow]")
+    s = gdf[col]
+    if isinstance(s.dtype, pd.StringDtype):
+        return s.fillna("").str.lower()
+    return s.fillna("").astype(str).str.lower()
+
+
+def coalesce_columns(gdf, cols):
+    out = gdf[cols[0]].copy()
+    for c in cols[1:]:
+        out = out.where(out.notna() & (out.astype(str) != ""), gdf[c])
+    return out